@@ -1,4 +1,5 @@
 import os
+import time
 
 import hydra
 import rootutils
@@ -10,13 +11,44 @@ os.environ["PROJECT_ROOT"] = str(rootutils.setup_root(search_from=__file__, indi
 logger.info(f"Project root inferred to be {os.environ['PROJECT_ROOT']}")
 
 
+def generate_and_save(generator, executor=None):
+    """Plans, generates and saves one dataset.
+
+    Returns the saved path, the number of records actually generated and the seconds spent generating
+    and saving.
+    """
+    plan = generator.plan_ecgs()
+    plan_fp = generator.save_plan(plan)
+    logger.info(f"Generation plan saved to {plan_fp}")
+
+    start = time.perf_counter()
+    ecgs = generator.generate_ecgs(plan, executor=executor)
+    generate_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    save_fp = generator.save_ecgs(ecgs)
+    logger.info(f"ECGs saved to {save_fp}")
+    if generator.annotations is not None:
+        annotations_fp = generator.save_annotations(generator.annotations)
+        logger.info(f"Annotations saved to {annotations_fp}")
+    if generator.stats is not None:
+        stats_fp = generator.save_stats(generator.stats)
+        logger.info(f"Stats saved to {stats_fp}")
+    save_seconds = time.perf_counter() - start
+
+    return {
+        "save_fp": save_fp,
+        "n_generated": generator.n_generated,
+        "generate_seconds": generate_seconds,
+        "save_seconds": save_seconds,
+    }
+
+
 @hydra.main(version_base=None, config_path="configs", config_name="generate_ecgs")
 def main(cfg: DictConfig):
     # instantiate the generator
     generator = instantiate(cfg.generator)
-    ecgs = generator.generate_ecgs()
-    save_fp = generator.save_ecgs(ecgs)
-    logger.info(f"ECGs saved to {save_fp}")
+    generate_and_save(generator)
 
     return 0
 
@@ -1,12 +1,75 @@
 import os
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
+from multiprocessing import shared_memory
 
 import numpy as np
+import pandas as pd
 from loguru import logger
 
-from synth_ecg.utils.tools import convert_vcg_to_12lead, solve_vcg_object
+from synth_ecg.utils.stats import ECGStats
+from synth_ecg.utils.tools import (
+    annotate_vcg_object,
+    convert_vcg_to_12lead,
+    fiducial_phases,
+    solve_vcg_object,
+    stream_vcg_object,
+)
 from synth_ecg.utils.vcg import VCG
 
+# cost of cropping, writing and summarizing one output sample relative to solving one ODE sample
+_CROP_COST = 0.01
+
+
+def _write_records(block_name, shape, indices, records, memmap=False):
+    # attach to the parent's output block only for the write, so a worker never keeps an
+    # unlinked block's pages alive after the parent is done with it
+    if memmap:
+        out = np.load(block_name, mmap_mode="r+")
+        for i, record in zip(indices, records):
+            out[i] = record
+        out.flush()
+        return
+
+    shm = shared_memory.SharedMemory(name=block_name)
+    try:
+        out = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+        for i, record in zip(indices, records):
+            out[i] = record
+    finally:
+        # drop the array view first, shared memory can't be closed while it is exported
+        out = None
+        shm.close()
+
+
+class _AnnotationWriter:
+    # appends (record, fiducial code, sample) rows to a raw int64 file as tasks finish,
+    # so annotations don't accumulate in the parent with memmap_output
+    def __init__(self, fp):
+        self.fp = fp
+        self.file = open(fp, "wb")
+        self.n_rows = 0
+
+    def append(self, annotation):
+        self.file.write(np.ascontiguousarray(annotation, dtype=np.int64).tobytes())
+        self.n_rows += len(annotation)
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+    def to_npy(self, fp, chunk_rows=1 << 20):
+        self.close()
+        out = np.lib.format.open_memmap(fp, mode="w+", dtype=np.int64, shape=(self.n_rows, 3))
+        if self.n_rows:
+            rows = np.memmap(self.fp, dtype=np.int64, mode="r", shape=(self.n_rows, 3))
+            for start in range(0, self.n_rows, chunk_rows):
+                out[start : start + chunk_rows] = rows[start : start + chunk_rows]
+            del rows
+        out.flush()
+        os.remove(self.fp)
+        return out
+
 
 class ECGGenerator:
     def __init__(self, params):
@@ -20,59 +83,354 @@ class ECGGenerator:
             if hasattr(self.cfg.generation_params, "perturbations")
             else []
         )
+        self.memmap_output = self.cfg.memmap_output if hasattr(self.cfg, "memmap_output") else False
+        self.annotate = self.cfg.annotate if hasattr(self.cfg, "annotate") else False
+        self.annotations = None
+        self.compute_stats = self.cfg.compute_stats if hasattr(self.cfg, "compute_stats") else False
+        self.stats = None
+        self.n_generated = None
+        self.task_size = self.cfg.task_size if hasattr(self.cfg, "task_size") else None
+        self.task_size = self.task_size or 64
+        self.max_in_flight = self.cfg.max_in_flight if hasattr(self.cfg, "max_in_flight") else None
+        if not self.max_in_flight:
+            n_workers = self.cfg.n_jobs if self.cfg.n_jobs > 0 else os.cpu_count() or 1
+            self.max_in_flight = 4 * n_workers
+
+        # plan column prefix for each perturbation, numbered only when a type is used more than once
+        names = [type(perturb).__name__ for perturb in self.perturbations]
+        self.perturbation_columns = [
+            f"{name}_{i}" if names.count(name) > 1 else name for i, name in enumerate(names)
+        ]
         logger.debug(
             f"Generator initialized with perturbations {[perturb.name for perturb in self.perturbations]}"
         )
 
+    @property
+    def save_fp(self):
+        return f"{self.cfg.output_dir}/ecgs.npy"
+
+    @property
+    def annotations_fp(self):
+        return f"{self.cfg.output_dir}/annotations.npy"
+
+    @property
+    def record_shape(self):
+        leads = self.cfg.sample_params.leads
+        return (int(self.save_duration * self.frequency), leads if leads is not None else 12)
+
+    @property
+    def max_start_point(self):
+        return int((self.duration - self.save_duration) * self.frequency)
+
     # Generate ECG
-    def generate_vcg(self, hr):
+    def generate_vcg(self, hr, perturbation_values=None):
         vcg_ode = VCG(hr)
-        for perturbation in self.perturbations:
-            vcg_ode = perturbation(vcg_ode)
+        if perturbation_values is None:
+            for perturbation in self.perturbations:
+                vcg_ode = perturbation(vcg_ode)
+            return vcg_ode
+
+        # planned values, None for perturbations that don't fire
+        for perturbation, values in zip(self.perturbations, perturbation_values):
+            if values is not None:
+                vcg_ode = perturbation.apply_perturbation(vcg_ode, *values)
         return vcg_ode
 
-    def generate_ecg(self, hr):
-        vcg_ode = self.generate_vcg(hr)
+    def solve_ecg(self, hr, perturbation_values=None):
+        return self.solve_vcg_ode(self.generate_vcg(hr, perturbation_values))
+
+    def solve_vcg_ode(self, vcg_ode):
         t, vcg = solve_vcg_object(vcg_ode, fs=self.frequency, duration=self.duration)
-        ecg = convert_vcg_to_12lead(vcg)
-        # return only the save duration
+        return self.vcg_to_leads(vcg)
 
-        start_point = np.random.randint(0, int((self.duration - self.save_duration) * self.frequency) + 1)
-        t = t[start_point : start_point + int(self.save_duration * self.frequency)]
-        ecg = ecg[start_point : start_point + int(self.save_duration * self.frequency)]
+    def vcg_to_leads(self, vcg):
+        ecg = convert_vcg_to_12lead(vcg)
 
         # TODO: fix this so you can return specific leads
         if self.cfg.sample_params.leads is not None:
             ecg = ecg[:, range(self.cfg.sample_params.leads)]
         return ecg
 
-    def generate_ecgs(self):
-        logger.info("Generating ECGs...")
-        heart_rates = np.random.randint(
-            self.cfg.generation_params.heart_rate.min,
-            self.cfg.generation_params.heart_rate.max,
-            size=self.cfg.n_samples,
+    def crop_ecg(self, ecg, start_point):
+        # return only the save duration
+        return ecg[start_point : start_point + int(self.save_duration * self.frequency)]
+
+    def annotate_ecg(self, vcg_ode, start_point, phases=None):
+        # fiducial points of a cropped record as (fiducial code, sample) rows, see tools.Fiducial_map
+        return annotate_vcg_object(
+            vcg_ode,
+            fs=self.frequency,
+            duration=self.duration,
+            start_point=start_point,
+            n_points=self.record_shape[0],
+            phases=phases,
         )
-        ecgs = []
-        with ProcessPoolExecutor(max_workers=self.cfg.n_jobs if self.cfg.n_jobs > 0 else None) as executor:
-            future_to_index = {executor.submit(self.generate_ecg, hr): i for i, hr in enumerate(heart_rates)}
 
-            for future in as_completed(future_to_index):
-                i = future_to_index[future]
+    def generate_ecg(self, hr):
+        ecg = self.solve_ecg(hr)
+        start_point = np.random.randint(0, self.max_start_point + 1)
+        return self.crop_ecg(ecg, start_point)
+
+    # Stream long ECGs
+    def stream_ecg(self, hr, duration, chunk_duration=60, perturbation_values=None):
+        # yields consecutive (samples, leads) chunks of one long record
+        vcg_ode = self.generate_vcg(hr, perturbation_values)
+        for _, vcg in stream_vcg_object(
+            vcg_ode, fs=self.frequency, duration=duration, chunk_duration=chunk_duration
+        ):
+            yield self.vcg_to_leads(vcg)
+
+    def save_long_ecg(self, hr, duration, fp, chunk_duration=60, perturbation_values=None):
+        """Writes one long (e.g. Holter) record to an npy file chunk by chunk."""
+        n_points = int(duration * self.frequency)
+        os.makedirs(os.path.dirname(os.path.abspath(fp)), exist_ok=True)
+        out = np.lib.format.open_memmap(
+            fp, mode="w+", dtype=np.float64, shape=(n_points, self.record_shape[1])
+        )
+        start = 0
+        for chunk in self.stream_ecg(hr, duration, chunk_duration, perturbation_values):
+            out[start : start + len(chunk)] = chunk
+            start += len(chunk)
+            out.flush()
+        del out
+
+        return fp
+
+    # Plan ECGs
+    def plan_ecgs(self, seed=None):
+        """Draws every sampling decision up front, one row per sample.
+
+        Columns are ``hr``, ``<Perturbation>.fired`` and ``<Perturbation>.<param>`` for each
+        perturbation (0 when it doesn't fire), ``start_point`` and the relative ``cost`` of its solve.
+        """
+        if seed is None and hasattr(self.cfg.generation_params, "seed"):
+            seed = self.cfg.generation_params.seed
+        rng = np.random.RandomState(seed)
+        n_samples = self.cfg.n_samples
+
+        plan = {
+            "hr": rng.randint(
+                self.cfg.generation_params.heart_rate.min,
+                self.cfg.generation_params.heart_rate.max,
+                size=n_samples,
+            )
+        }
+        for column, perturbation in zip(self.perturbation_columns, self.perturbations):
+            fired = rng.rand(n_samples) < perturbation.probability
+            values = perturbation.sample_values(rng, size=n_samples)
+            plan[f"{column}.fired"] = fired
+            for param, value in zip(perturbation.param_names, values):
+                plan[f"{column}.{param}"] = np.where(fired, value, 0)
+        plan["start_point"] = rng.randint(0, self.max_start_point + 1, size=n_samples)
+        # solver work grows with the number of solved samples, and slow heart rates take the longest
+        plan["cost"] = (self.duration + 10) * self.frequency * 60 / plan["hr"]
+
+        return pd.DataFrame(plan)
+
+    def save_plan(self, plan):
+        os.makedirs(self.cfg.output_dir, exist_ok=True)
+        plan.to_csv(f"{self.cfg.output_dir}/plan.csv", index_label="index")
+
+        return f"{self.cfg.output_dir}/plan.csv"
+
+    @staticmethod
+    def load_plan(fp):
+        return pd.read_csv(fp, index_col="index")
+
+    def _perturbation_values(self, row):
+        values = []
+        for column, perturbation in zip(self.perturbation_columns, self.perturbations):
+            if row[f"{column}.fired"]:
+                values.append(tuple(row[f"{column}.{param}"] for param in perturbation.param_names))
+            else:
+                values.append(None)
+        return values
+
+    def _iter_plan_tasks(self, plan):
+        # identical solves are grouped so they run once, groups are split into tasks of at most
+        # task_size records so none of them straggles, and tasks come most expensive first
+        if len(plan) == 0:
+            return
+        key_columns = [column for column in plan.columns if column not in ("start_point", "cost")]
+        codes = plan.groupby(key_columns, sort=False).ngroup().to_numpy()
+        order = np.argsort(codes, kind="stable")
+        new_group = np.concatenate([[True], np.diff(codes[order]) != 0])
+        group_starts = np.flatnonzero(new_group)
+        rank = np.arange(len(order)) - group_starts[np.cumsum(new_group) - 1]
+
+        task_starts = np.flatnonzero(rank % self.task_size == 0)
+        task_ends = np.append(task_starts[1:], len(order))
+        # one solve plus one crop per record
+        crop_cost = _CROP_COST * self.record_shape[0]
+        task_costs = plan["cost"].to_numpy()[order[task_starts]] + crop_cost * (task_ends - task_starts)
+
+        start_points = plan["start_point"].to_numpy()
+        for task in np.argsort(-task_costs, kind="stable"):
+            indices = order[task_starts[task] : task_ends[task]]
+            row = plan.iloc[indices[0]]
+            yield (
+                row["hr"],
+                self._perturbation_values(row),
+                indices,
+                start_points[indices],
+            )
+
+    def _generate_into(self, block_name, shape, hr, perturbation_values, indices, start_points):
+        # solve once, then write each crop straight into the parent's output block,
+        # only the indices go back over the pipe
+        vcg_ode = self.generate_vcg(hr, perturbation_values)
+        ecg = self.solve_vcg_ode(vcg_ode)
+        records = [self.crop_ecg(ecg, start_point) for start_point in start_points]
+        _write_records(block_name, shape, indices, records, memmap=self.memmap_output)
+
+        # statistics are accumulated here so the parent never has to read the records back
+        stats = ECGStats(shape[2]) if self.compute_stats else None
+        if stats is not None:
+            for i, record in zip(indices, records):
+                stats.update(i, record)
+
+        if not self.annotate:
+            return indices, None, stats
+        phases = fiducial_phases(vcg_ode)
+        if stats is not None and "T_off" not in phases:
+            stats.flagged["t_wave_overlap"].extend(int(i) for i in indices)
+        annotations = []
+        for i, start_point in zip(indices, start_points):
+            annotation = self.annotate_ecg(vcg_ode, start_point, phases=phases)
+            annotations.append(np.column_stack([np.full(len(annotation), i), annotation]))
+        return indices, np.concatenate(annotations), stats
+
+    def _run_plan(self, executor, block_name, shape, plan, generated, annotations, stats):
+        # keep at most max_in_flight solves submitted, new ones go in only as results are drained
+        tasks = self._iter_plan_tasks(plan)
+        in_flight = {}
+        n_solves = 0
+        while True:
+            for task in islice(tasks, self.max_in_flight - len(in_flight)):
+                in_flight[executor.submit(self._generate_into, block_name, shape, *task)] = task[2]
+                n_solves += 1
+            if not in_flight:
+                break
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                indices = in_flight.pop(future)
                 try:
-                    ecg = future.result()
-                    ecgs.append(ecg)
+                    _, annotation, task_stats = future.result()
+                    generated[indices] = True
+                    if annotation is not None:
+                        annotations.append(annotation)
+                    if task_stats is not None:
+                        stats.merge(task_stats)
                 except Exception as e:
-                    logger.error(f"Error generating ECG {i+1}: {e}")
+                    logger.error(f"Error generating ECGs {[i + 1 for i in indices]}: {e}")
+        logger.debug(f"Ran {n_solves} unique solves for {len(plan)} ECGs")
+
+    def generate_ecgs(self, plan=None, executor=None):
+        logger.info("Generating ECGs...")
+        if plan is None:
+            plan = self.plan_ecgs()
+        shape = (len(plan), *self.record_shape)
+        generated = np.zeros(len(plan), dtype=bool)
+        stats = ECGStats(shape[2]) if self.compute_stats else None
+        if self.memmap_output and self.annotate:
+            os.makedirs(self.cfg.output_dir, exist_ok=True)
+            annotations = _AnnotationWriter(f"{self.annotations_fp}.part")
+        else:
+            annotations = []
+        # a pool passed in (e.g. by a sweep) stays open for the caller
+        own_executor = executor is None
+        if own_executor:
+            executor = ProcessPoolExecutor(max_workers=self.cfg.n_jobs if self.cfg.n_jobs > 0 else None)
 
-        logger.debug(f"Generated {len(ecgs)} ECGs, with shape {np.array(ecgs).shape}")
+        try:
+            if self.memmap_output:
+                # records go straight to disk so memory no longer grows with n_samples
+                os.makedirs(self.cfg.output_dir, exist_ok=True)
+                ecgs = np.lib.format.open_memmap(self.save_fp, mode="w+", dtype=np.float64, shape=shape)
+                self._run_plan(executor, self.save_fp, shape, plan, generated, annotations, stats)
+                # there's no cheap way to drop rows from the file, so failed records are left as NaN
+                ecgs[~generated] = np.nan
+                ecgs.flush()
+            else:
+                block = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * 8, 1))
+                try:
+                    out = np.ndarray(shape, dtype=np.float64, buffer=block.buf)
+                    self._run_plan(executor, block.name, shape, plan, generated, annotations, stats)
+                    # single copy out of shared memory, dropping records that failed
+                    ecgs = out[generated]
+                finally:
+                    out = None
+                    block.close()
+                    block.unlink()
+        finally:
+            if own_executor:
+                executor.shutdown()
+            if isinstance(annotations, _AnnotationWriter):
+                annotations.close()
+
+        if self.annotate:
+            if isinstance(annotations, _AnnotationWriter):
+                # rows are grouped by record in completion order, and sorted by sample within a record
+                self.annotations = annotations.to_npy(self.annotations_fp)
+            else:
+                self.annotations = self._collect_annotations(annotations, generated)
+        if self.compute_stats:
+            if not self.memmap_output:
+                stats.reindex(np.cumsum(generated) - 1)
+            # flagged holds output record indices, failures are kept apart as plan row indices
+            # (with memmap_output the two coincide and failed records are NaN)
+            stats.failed_plan_rows = np.flatnonzero(~generated).tolist()
+            self.stats = stats
+            for check, indices in stats.flagged.items():
+                if indices:
+                    logger.warning(f"{len(indices)} ECGs flagged as {check}")
+            if stats.failed_plan_rows:
+                logger.warning(f"{len(stats.failed_plan_rows)} plan rows failed to generate")
+
+        self.n_generated = int(generated.sum())
+        logger.debug(f"Generated {self.n_generated} ECGs, with shape {ecgs.shape}")
         return ecgs
 
+    def _collect_annotations(self, annotations, generated):
+        # one (record, fiducial code, sample) row per fiducial point, sorted by record then sample
+        if not annotations:
+            return np.empty((0, 3), dtype=np.int64)
+        annotations = np.concatenate(annotations)
+        annotations = annotations[np.lexsort((annotations[:, 2], annotations[:, 0]))]
+        if not self.memmap_output:
+            # failed records were dropped from the output, so renumber the rest
+            annotations[:, 0] = (np.cumsum(generated) - 1)[annotations[:, 0]]
+        return annotations
+
     def save_ecgs(self, ecgs):
         logger.info("Saving ECGs...")
         # make a directory
         os.makedirs(self.cfg.output_dir, exist_ok=True)
+        # memmapped output was already written in place
+        if isinstance(ecgs, np.memmap) and os.path.abspath(ecgs.filename) == os.path.abspath(self.save_fp):
+            ecgs.flush()
+            return self.save_fp
         # save as npy
-        np.save(f"{self.cfg.output_dir}/ecgs.npy", ecgs)
+        np.save(self.save_fp, ecgs)
 
-        return f"{self.cfg.output_dir}/ecgs.npy"
+        return self.save_fp
+
+    def save_annotations(self, annotations):
+        logger.info("Saving annotations...")
+        os.makedirs(self.cfg.output_dir, exist_ok=True)
+        # memmapped annotations were already written in place
+        if isinstance(annotations, np.memmap) and os.path.abspath(annotations.filename) == os.path.abspath(
+            self.annotations_fp
+        ):
+            annotations.flush()
+            return self.annotations_fp
+        np.save(self.annotations_fp, annotations)
+
+        return self.annotations_fp
+
+    def save_stats(self, stats):
+        logger.info("Saving stats...")
+        os.makedirs(self.cfg.output_dir, exist_ok=True)
+
+        return stats.save(f"{self.cfg.output_dir}/stats.json")
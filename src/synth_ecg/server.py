@@ -0,0 +1,294 @@
+import asyncio
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+
+import hydra
+import numpy as np
+import rootutils
+from hydra.utils import instantiate
+from loguru import logger
+from omegaconf import DictConfig, OmegaConf
+
+from synth_ecg.utils import vcg_perturbations
+
+os.environ["PROJECT_ROOT"] = str(rootutils.setup_root(search_from=__file__, indicator="pyproject.toml"))
+
+# only perturbation constructors may be instantiated from client requests
+ALLOWED_TARGETS = {
+    f"{vcg_perturbations.__name__}.{name}.initialize"
+    for name, obj in vars(vcg_perturbations).items()
+    if isinstance(obj, type)
+    and issubclass(obj, vcg_perturbations.Perturbation)
+    and obj is not vcg_perturbations.Perturbation
+}
+
+
+def _validate_params(value):
+    # perturbation parameters are plain numbers, possibly nested (e.g. {"min": 1, "max": 2}).
+    # anything else could carry hydra keys or interpolations into instantiate
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if not isinstance(key, str) or key.startswith("_"):
+                raise ValueError(f"Invalid perturbation parameter {key!r}")
+            _validate_params(item)
+    elif isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f"Invalid perturbation parameter value {value!r}")
+
+
+def validate_perturbations(perturbations):
+    if not isinstance(perturbations, list):
+        raise ValueError("perturbations must be a list")
+    for perturbation in perturbations:
+        if not isinstance(perturbation, dict) or perturbation.get("_target_") not in ALLOWED_TARGETS:
+            raise ValueError(f"Perturbation target must be one of {sorted(ALLOWED_TARGETS)}")
+        _validate_params({key: value for key, value in perturbation.items() if key != "_target_"})
+    return perturbations
+
+
+# generators are built once per worker process and per perturbation spec, then reused across batches.
+# specs come from clients, so only the most recently used ones are kept
+_WORKER_PARAMS = None
+_MAX_WORKER_GENERATORS = 8
+
+
+def _init_worker(params):
+    global _WORKER_PARAMS
+    _WORKER_PARAMS = params
+
+
+@lru_cache(maxsize=_MAX_WORKER_GENERATORS)
+def _get_worker_generator(spec_key):
+    perturbations = json.loads(spec_key)
+    params = OmegaConf.merge(_WORKER_PARAMS, {"generation_params": {"perturbations": perturbations}})
+    return instantiate({"_target_": "synth_ecg.generator.ECGGenerator", "params": params})
+
+
+def _generate_batch(spec_key, heart_rates, seeds):
+    generator = _get_worker_generator(spec_key)
+    ecgs = []
+    for hr, seed in zip(heart_rates, seeds):
+        # seed each record on its own so results don't depend on how requests were coalesced
+        np.random.seed(seed)
+        ecgs.append(generator.generate_ecg(hr))
+    return np.stack(ecgs)
+
+
+class ECGServer:
+    """Serves ECG generation requests from one warm worker pool.
+
+    Clients send one JSON request per line, e.g.
+    ``{"count": 8, "heart_rate": {"min": 50, "max": 90}, "perturbations": [...], "seed": 0}``.
+    The server answers with a JSON header line ``{"count", "shape", "dtype"}`` followed by the raw
+    bytes of ``count`` records in request order, each streamed as soon as it is ready. Concurrent
+    requests that share a perturbation spec are coalesced into batches for the pool.
+    """
+
+    def __init__(self, params, max_batch_size=256, max_wait_ms=10, chunk_size=16):
+        self.cfg = params
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.chunk_size = chunk_size
+
+        leads = self.cfg.sample_params.leads
+        self.record_shape = (
+            int(self.cfg.sample_params.save_duration * self.cfg.sample_params.frequency),
+            leads if leads is not None else 12,
+        )
+        self.dtype = np.dtype(np.float64)
+
+        self.default_perturbations = (
+            OmegaConf.to_container(self.cfg.generation_params.perturbations, resolve=True)
+            if hasattr(self.cfg.generation_params, "perturbations")
+            else []
+        )
+        self.executor = None
+        self.queue = None
+        self.batcher = None
+
+    def _make_executor(self):
+        return ProcessPoolExecutor(
+            max_workers=self.cfg.n_jobs if self.cfg.n_jobs > 0 else None,
+            initializer=_init_worker,
+            initargs=(OmegaConf.to_container(self.cfg, resolve=True),),
+        )
+
+    def _replace_broken_executor(self, executor):
+        # a worker died (e.g. it was OOM killed) and the pool won't take more work, so start a fresh one
+        if self.executor is executor:
+            logger.error("Worker pool broke, starting a new one")
+            executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = self._make_executor()
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.executor = self._make_executor()
+        self.batcher = asyncio.create_task(self._batch_loop())
+
+    async def stop(self):
+        if self.batcher is not None:
+            self.batcher.cancel()
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+
+    async def serve(self, socket_path=None, host="127.0.0.1", port=8765):
+        await self.start()
+        if socket_path is not None:
+            server = await asyncio.start_unix_server(self.handle_client, path=socket_path)
+            logger.info(f"Serving ECGs on unix socket {socket_path}")
+        else:
+            server = await asyncio.start_server(self.handle_client, host=host, port=port)
+            logger.info(f"Serving ECGs on {host}:{port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.stop()
+
+    def submit(self, count, heart_rate=None, perturbations=None, seed=None):
+        """Queues ``count`` records and returns one future per record."""
+        if self.batcher is None or self.batcher.done():
+            raise RuntimeError("Server is not accepting requests")
+        heart_rate = heart_rate or {}
+        hr_min = heart_rate.get("min", self.cfg.generation_params.heart_rate.min)
+        hr_max = heart_rate.get("max", self.cfg.generation_params.heart_rate.max)
+        if perturbations is None:
+            perturbations = self.default_perturbations
+        else:
+            # client specs are instantiated in the workers, so only known perturbations are accepted
+            perturbations = validate_perturbations(perturbations)
+        spec_key = json.dumps(perturbations, sort_keys=True)
+
+        rng = np.random.default_rng(seed)
+        heart_rates = rng.integers(hr_min, hr_max, size=count)
+        seeds = rng.integers(2**32, size=count)
+
+        loop = asyncio.get_running_loop()
+        futures = []
+        for hr, sample_seed in zip(heart_rates, seeds):
+            future = loop.create_future()
+            self.queue.put_nowait((spec_key, int(hr), int(sample_seed), future))
+            futures.append(future)
+        return futures
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            groups = {}
+            for item in batch:
+                groups.setdefault(item[0], []).append(item)
+            for spec_key, items in groups.items():
+                for i in range(0, len(items), self.chunk_size):
+                    self._dispatch(spec_key, items[i : i + self.chunk_size])
+
+    def _dispatch(self, spec_key, items):
+        loop = asyncio.get_running_loop()
+        futures = [item[3] for item in items]
+        executor = self.executor
+
+        def fail(error):
+            for future in futures:
+                if not future.done():
+                    future.set_exception(error)
+            if isinstance(error, BrokenProcessPool):
+                self._replace_broken_executor(executor)
+
+        try:
+            pool_future = loop.run_in_executor(
+                executor,
+                _generate_batch,
+                spec_key,
+                [item[1] for item in items],
+                [item[2] for item in items],
+            )
+        except Exception as e:
+            fail(e)
+            return
+
+        def resolve(done):
+            if done.cancelled() or done.exception() is not None:
+                fail(RuntimeError("generation cancelled") if done.cancelled() else done.exception())
+                return
+            for future, ecg in zip(futures, done.result()):
+                if not future.done():
+                    future.set_result(ecg)
+
+        pool_future.add_done_callback(resolve)
+
+    async def handle_client(self, reader, writer):
+        try:
+            while line := await reader.readline():
+                try:
+                    request = json.loads(line)
+                    futures = self.submit(
+                        int(request["count"]),
+                        heart_rate=request.get("heart_rate"),
+                        perturbations=request.get("perturbations"),
+                        seed=request.get("seed"),
+                    )
+                except Exception as e:
+                    writer.write(json.dumps({"error": str(e)}).encode() + b"\n")
+                    await writer.drain()
+                    continue
+
+                header = {"count": len(futures), "shape": self.record_shape, "dtype": self.dtype.str}
+                writer.write(json.dumps(header).encode() + b"\n")
+                for i, future in enumerate(futures):
+                    try:
+                        ecg = await future
+                    except Exception as e:
+                        # keep the stream aligned, failed records come back as NaN
+                        logger.error(f"Error generating ECG {i+1}: {e}")
+                        ecg = np.full(self.record_shape, np.nan)
+                    writer.write(np.ascontiguousarray(ecg, dtype=self.dtype).tobytes())
+                    await writer.drain()
+        except (ConnectionResetError, BrokenPipeError):
+            logger.debug("Client disconnected")
+        finally:
+            writer.close()
+
+
+async def request_ecgs(count, socket_path=None, host="127.0.0.1", port=8765, **request):
+    """Fetches ``count`` records from a running :class:`ECGServer` as one array."""
+    if socket_path is not None:
+        reader, writer = await asyncio.open_unix_connection(socket_path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(json.dumps({"count": count, **request}).encode() + b"\n")
+        await writer.drain()
+        header = json.loads(await reader.readline())
+        if "error" in header:
+            raise ValueError(header["error"])
+        shape = (header["count"], *header["shape"])
+        dtype = np.dtype(header["dtype"])
+        data = await reader.readexactly(int(np.prod(shape)) * dtype.itemsize)
+        return np.frombuffer(data, dtype=dtype).reshape(shape)
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+@hydra.main(version_base=None, config_path="configs", config_name="serve_ecgs")
+def main(cfg: DictConfig):
+    server = ECGServer(cfg.generator.params, **cfg.server)
+    asyncio.run(server.serve(socket_path=cfg.socket_path, host=cfg.host, port=cfg.port))
+
+    return 0
+
+
+if __name__ == "__main__":
+    main()
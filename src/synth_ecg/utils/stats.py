@@ -0,0 +1,104 @@
+import json
+
+import numpy as np
+
+
+class ECGStats:
+    """Mergeable per-lead statistics and QC flags for a set of (samples, leads) records.
+
+    Moments are accumulated with Welford/Chan updates and amplitudes with a fixed-bin histogram
+    (values outside ``hist_range`` are counted in the end bins), so accumulators built in separate
+    workers can be merged exactly in any order.
+    """
+
+    def __init__(self, n_leads, n_bins=200, hist_range=(-5, 5), flat_tol=1e-6):
+        self.n_records = 0
+        self.count = np.zeros(n_leads, dtype=np.int64)
+        self.mean = np.zeros(n_leads)
+        self.m2 = np.zeros(n_leads)
+        self.min = np.full(n_leads, np.inf)
+        self.max = np.full(n_leads, -np.inf)
+
+        self.bins = np.linspace(hist_range[0], hist_range[1], n_bins + 1)
+        self.hist = np.zeros((n_leads, n_bins), dtype=np.int64)
+
+        self.flat_tol = flat_tol
+        # output record indices failing each QC check. t_wave_overlap is filled in by the generator
+        # for annotated records whose T wave runs into the next beat and so has no T fiducials
+        self.flagged = {"non_finite": [], "flat_line": [], "t_wave_overlap": []}
+        # plan row indices (the index column of plan.csv) whose generation failed
+        self.failed_plan_rows = []
+
+    def _merge_moments(self, count, mean, m2):
+        total = self.count + count
+        delta = mean - self.mean
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.mean = np.where(total > 0, self.mean + delta * count / total, 0)
+            self.m2 = np.where(total > 0, self.m2 + m2 + delta**2 * self.count * count / total, 0)
+        self.count = total
+
+    def update(self, i, ecg):
+        self.n_records += 1
+        finite = np.isfinite(ecg)
+        if not finite.all():
+            self.flagged["non_finite"].append(int(i))
+
+        count = finite.sum(axis=0)
+        values = np.where(finite, ecg, 0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(count > 0, values.sum(axis=0) / count, 0)
+        m2 = np.where(finite, (values - mean) ** 2, 0).sum(axis=0)
+        self._merge_moments(count, mean, m2)
+
+        lead_min = np.where(finite, ecg, np.inf).min(axis=0)
+        lead_max = np.where(finite, ecg, -np.inf).max(axis=0)
+        self.min = np.minimum(self.min, lead_min)
+        self.max = np.maximum(self.max, lead_max)
+        if (lead_max - lead_min < self.flat_tol).any():
+            self.flagged["flat_line"].append(int(i))
+
+        clipped = np.clip(ecg, self.bins[0], self.bins[-1])
+        for lead in range(ecg.shape[1]):
+            self.hist[lead] += np.histogram(clipped[finite[:, lead], lead], bins=self.bins)[0]
+
+    def merge(self, other):
+        self.n_records += other.n_records
+        self._merge_moments(other.count, other.mean, other.m2)
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        self.hist += other.hist
+        for check, indices in other.flagged.items():
+            self.flagged.setdefault(check, []).extend(indices)
+        self.failed_plan_rows.extend(other.failed_plan_rows)
+        return self
+
+    def reindex(self, index_map):
+        # renumber flagged records, e.g. after failed records were dropped from the output
+        self.flagged = {
+            check: [int(index_map[i]) for i in indices] for check, indices in self.flagged.items()
+        }
+
+    @property
+    def std(self):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.count > 0, np.sqrt(self.m2 / self.count), np.nan)
+
+    def to_dict(self):
+        return {
+            "n_records": self.n_records,
+            "count": self.count.tolist(),
+            "mean": self.mean.tolist(),
+            "std": self.std.tolist(),
+            "min": self.min.tolist(),
+            "max": self.max.tolist(),
+            "bins": self.bins.tolist(),
+            "hist": self.hist.tolist(),
+            "flagged": {check: sorted(indices) for check, indices in self.flagged.items()},
+            "failed_plan_rows": sorted(self.failed_plan_rows),
+        }
+
+    def save(self, fp):
+        with open(fp, "w") as f:
+            json.dump(self.to_dict(), f)
+
+        return fp
@@ -27,6 +27,27 @@ Dower_lead_map = {
     "V6": 11,
 }
 
+# dictionary for fiducial codes in annotation arrays
+Fiducial_map = {
+    "P_on": 0,
+    "P_peak": 1,
+    "P_off": 2,
+    "QRS_on": 3,
+    "R_peak": 4,
+    "QRS_off": 5,
+    "T_on": 6,
+    "T_peak": 7,
+    "T_off": 8,
+}
+
+# gaussians making up each wave in the x, y and z components of the VCG. the rest
+# (x 6 and 10, y 8, z 9) are small ST and baseline terms that don't belong to a wave
+Wave_gaussians = {
+    "P": ([0, 1], [0, 1, 2], [0, 1, 2]),
+    "QRS": ([2, 3, 4, 5], [3, 4, 5], [3, 4, 5]),
+    "T": ([7, 8, 9], [6, 7], [6, 7, 8]),
+}
+
 
 # rotation matrices. Input in degrees
 def Rx(x):
@@ -63,6 +84,141 @@ def solve_vcg_object(vcg_ode, fs=512, duration=10, v0=np.array([0, 0.3, 0.3, 0.3
     return sol.t, sol.y.T[:, 1:]
 
 
+# solve input ode object in fixed length chunks, carrying the state across chunk boundaries.
+# yields (t, vcg) for each chunk after the first 10 seconds, so memory is bounded by chunk_duration
+# instead of duration. samples are spaced exactly 1 / fs apart.
+def stream_vcg_object(vcg_ode, fs=512, duration=10, chunk_duration=60, v0=np.array([0, 0.3, 0.3, 0.3])):
+    n_settle = int(10 * fs)
+    n_total = n_settle + int(duration * fs)
+    chunk_size = max(int(chunk_duration * fs), 1)
+
+    v = np.asarray(v0, dtype=float)
+    start = 0
+    while start < n_total:
+        # drop the first 10 seconds in one chunk of its own
+        end = n_settle if start < n_settle else min(start + chunk_size, n_total)
+        # integrate up to the first sample of the next chunk so it can start from that state
+        t_eval = np.arange(start, end + 1) / fs
+        sol = solve_ivp(vcg_ode.call, [t_eval[0], t_eval[-1]], v, t_eval=t_eval)
+        v = sol.y[:, -1]
+        if start >= n_settle:
+            yield sol.t[:-1], sol.y[1:, :-1].T
+        start = end
+
+
+# value of one VCG component at phases phi, summing the same gaussians as VCG.call integrates
+def gaussian_sum(phi, theta, alpha, b):
+    dtheta = np.remainder(phi[:, None] - theta, 2 * np.pi) - np.pi
+    return np.sum(alpha * np.exp(-(dtheta**2) / (2 * b**2)), axis=1)
+
+
+# phase of each fiducial point within the cardiac cycle, in [0, 2pi).
+# each wave's envelope is the magnitude of the vector its gaussians add up to, so small or
+# wide terms only move a boundary once they are a real part of the wave. a wave starts and ends
+# where its envelope crosses threshold * its peak. the P wave is searched in the half cycle before
+# the QRS and the T wave between the QRS and the next beat's P_on, so a long QT can reach past
+# the half cycle without wrapping. where neighbouring waves overlap, they are split where the
+# later one's envelope overtakes the earlier one's. the R peak is the largest lead II deflection
+# of the whole model inside the QRS. if the T wave hasn't ended by the next P_on it runs into the
+# next beat and can't be delimited, so the T fiducials are left out.
+def fiducial_phases(vcg_ode, threshold=0.1, n_grid=4096):
+    params = (
+        (vcg_ode.theta_x, vcg_ode.alpha_x, vcg_ode.b_x),
+        (vcg_ode.theta_y, vcg_ode.alpha_y, vcg_ode.b_y),
+        (vcg_ode.theta_z, vcg_ode.alpha_z, vcg_ode.b_z),
+    )
+
+    def envelope(phi, wave):
+        components = [
+            gaussian_sum(phi, theta[idx], alpha[idx], b[idx])
+            for (theta, alpha, b), idx in zip(params, Wave_gaussians[wave])
+        ]
+        return np.linalg.norm(np.column_stack(components), axis=1)
+
+    phi = np.linspace(0, 2 * np.pi, n_grid, endpoint=False)
+    center = phi[np.argmax(envelope(phi, "QRS"))]
+    # one and a half cycles from half a cycle before the QRS, so the T wave can reach the next P_on
+    u = -np.pi + np.arange(3 * n_grid // 2) * 2 * np.pi / n_grid
+    phi = center + u
+    envelopes = {wave: envelope(phi, wave) for wave in Wave_gaussians}
+
+    def wave_bounds(env, window):
+        env = np.where(window, env, 0)
+        peak = np.argmax(env)
+        above = np.flatnonzero(env > threshold * env[peak])
+        return [above[0], peak, above[-1]] if len(above) else [peak, peak, peak]
+
+    bounds = {
+        "P": wave_bounds(envelopes["P"], u < 0),
+        "QRS": wave_bounds(envelopes["QRS"], u < np.pi),
+    }
+    t_window = (u > 0) & (u < u[bounds["P"][0]] + 2 * np.pi)
+    bounds["T"] = wave_bounds(envelopes["T"], t_window)
+    t_overlaps = bounds["T"][2] == np.flatnonzero(t_window)[-1]
+
+    lead_ii = sum(
+        DowerMatrix[axis, Dower_lead_map["II"]] * gaussian_sum(phi, *axis_params)
+        for axis, axis_params in enumerate(params)
+    )
+    on, _, off = bounds["QRS"]
+    if off - on >= 2:
+        bounds["QRS"][1] = on + 1 + np.argmax(lead_ii[on + 1 : off])
+
+    for first, second in (("P", "QRS"), ("QRS", "T")):
+        a, b = bounds[first], bounds[second]
+        if a[2] > b[0]:
+            between = np.arange(a[1] + 1, b[1])
+            crossing = between[envelopes[second][between] >= envelopes[first][between]]
+            a[2] = b[0] = crossing[0] if len(crossing) else (a[1] + b[1]) // 2
+
+    names = {
+        "P": ("P_on", "P_peak", "P_off"),
+        "QRS": ("QRS_on", "R_peak", "QRS_off"),
+        "T": ("T_on", "T_peak", "T_off"),
+    }
+    if t_overlaps:
+        del names["T"]
+    phases = {}
+    for wave, wave_names in names.items():
+        for name, idx in zip(wave_names, bounds[wave]):
+            phases[name] = np.remainder(phi[idx], 2 * np.pi)
+    return phases
+
+
+# sample indices of each fiducial point in a window cut from the output of solve_vcg_object.
+# theta starts at 0 and grows as w * t, so every crossing of a fiducial phase is known in closed form.
+# returns an (n, 2) array of (fiducial code, sample index) rows sorted by sample.
+def annotate_vcg_object(vcg_ode, fs=512, duration=10, start_point=0, n_points=None, phases=None):
+    if phases is None:
+        phases = fiducial_phases(vcg_ode)
+    total = duration + 10
+    dt = total / (int(total * fs) - 1)
+    first = fs * 10 + start_point
+    if n_points is None:
+        n_points = int(total * fs) - first
+
+    # a sample k covers times within half a step of k * dt
+    t_start = (first - 0.5) * dt
+    t_end = (first + n_points - 0.5) * dt
+
+    rows = []
+    times = []
+    for name, phase in phases.items():
+        cycles = np.arange(
+            np.ceil((vcg_ode.w * t_start - phase) / (2 * np.pi)),
+            np.floor((vcg_ode.w * t_end - phase) / (2 * np.pi)) + 1,
+        )
+        t = (phase + 2 * np.pi * cycles) / vcg_ode.w
+        samples = np.rint(t / dt).astype(np.int64) - first
+        keep = (samples >= 0) & (samples < n_points)
+        rows.append(np.column_stack([np.full(keep.sum(), Fiducial_map[name]), samples[keep]]))
+        times.append(t[keep])
+
+    # sorted by exact time, so points rounded onto the same sample keep their beat order
+    annotations = np.concatenate(rows).astype(np.int64)
+    return annotations[np.argsort(np.concatenate(times), kind="stable")]
+
+
 def convert_vcg_to_12lead(vcg):
     return vcg @ DowerMatrix
 
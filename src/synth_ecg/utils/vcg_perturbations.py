@@ -16,6 +16,9 @@ def change_HR(vcg_ode_original, target_hr):
 
 
 class Perturbation(ABC):
+    # names of the values drawn by sample_values, in the order apply_perturbation takes them
+    param_names = ()
+
     def __init__(self, probability=0):
         super().__init__()
         self.probability = probability
@@ -24,27 +27,41 @@ class Perturbation(ABC):
     def initialize(cls: type[T], **kwargs) -> T:
         return cls(DictConfig(kwargs, flags={"allow_objects": True}))
 
+    def sample_values(self, rng=np.random, size=None):
+        return ()
+
     @abstractmethod
-    def apply_perturbation(self, vcg_ode_original):
+    def apply_perturbation(self, vcg_ode_original, *values):
         pass
 
+    def sample(self, rng=np.random):
+        # values for one draw, or None if the perturbation doesn't fire
+        if rng.rand() < self.probability:
+            return self.sample_values(rng)
+        return None
+
     def __call__(self, vcg_ode):
-        if np.random.rand() < self.probability:
-            return self.apply_perturbation(vcg_ode)
+        values = self.sample()
+        if values is not None:
+            return self.apply_perturbation(vcg_ode, *values)
         return vcg_ode
 
 
 class QTElongation(Perturbation):
+    param_names = ("ms_forward",)
+
     def __init__(self, cfg):
         super().__init__()
         self.name = "QT Elongation"
         self.min = cfg.ms_forward.min
         self.max = cfg.ms_forward.max
 
-    def apply_perturbation(self, vcg_ode_original):
-        vcg_ode = copy.deepcopy(vcg_ode_original)
+    def sample_values(self, rng=np.random, size=None):
         # randomly select a value between min and max
-        ms_forward = np.random.randint(self.min, self.max)
+        return (rng.randint(self.min, self.max, size=size),)
+
+    def apply_perturbation(self, vcg_ode_original, ms_forward):
+        vcg_ode = copy.deepcopy(vcg_ode_original)
 
         th_x = vcg_ode.theta_x
         th_y = vcg_ode.theta_y
@@ -78,6 +95,8 @@ class QTElongation(Perturbation):
 
 
 class WideQRS(Perturbation):
+    param_names = ("percent_widened", "scaledown")
+
     def __init__(self, cfg):
         super().__init__()
         self.name = "Wide QRS"
@@ -86,11 +105,14 @@ class WideQRS(Perturbation):
         self.scale_min = cfg.scale.min
         self.scale_max = cfg.scale.max
 
-    def apply_perturbation(self, vcg_ode_original):
-        vcg_ode = copy.deepcopy(vcg_ode_original)
+    def sample_values(self, rng=np.random, size=None):
         # randomly select a value between min and max
-        percent_widened = np.random.randint(self.min, self.max)
-        scaledown = np.random.randint(self.scale_min, self.scale_max)
+        percent_widened = rng.randint(self.wide_min, self.wide_max, size=size)
+        scaledown = rng.randint(self.scale_min, self.scale_max, size=size)
+        return percent_widened, scaledown
+
+    def apply_perturbation(self, vcg_ode_original, percent_widened, scaledown):
+        vcg_ode = copy.deepcopy(vcg_ode_original)
 
         # th_x = vcg_ode.theta_x
         # th_y = vcg_ode.theta_y
@@ -163,15 +185,18 @@ class WideQRS(Perturbation):
 
 
 class QRSAmplitude(Perturbation):
+    param_names = ("scale",)
+
     def __init__(self, scale):
         super().__init__()
         self.name = "QRS Amplitude"
         self.min = scale.min
         self.max = scale.max
 
-    def apply_perturbation(self, vcg_ode_original):
-        scale = np.random.randint(self.min, self.max)
+    def sample_values(self, rng=np.random, size=None):
+        return (rng.randint(self.min, self.max, size=size),)
 
+    def apply_perturbation(self, vcg_ode_original, scale):
         vcg_ode = copy.deepcopy(vcg_ode_original)
 
         b_x = vcg_ode.b_x
@@ -207,15 +232,18 @@ class QRSAmplitude(Perturbation):
 
 
 class PWaveAmplitude(Perturbation):
+    param_names = ("scale",)
+
     def __init__(self, scale):
         super().__init__()
         self.name = "P Wave Amplitude"
         self.min = scale.min
         self.max = scale.max
 
-    def apply_perturbation(self, vcg_ode_original):
-        scale = np.random.randint(self.min, self.max)
+    def sample_values(self, rng=np.random, size=None):
+        return (rng.randint(self.min, self.max, size=size),)
 
+    def apply_perturbation(self, vcg_ode_original, scale):
         vcg_ode = copy.deepcopy(vcg_ode_original)
 
         b_x = vcg_ode.b_x
@@ -251,15 +279,18 @@ class PWaveAmplitude(Perturbation):
 
 
 class TWaveAmplitude(Perturbation):
+    param_names = ("scale",)
+
     def __init__(self, scale):
         super().__init__()
         self.name = "T Wave Amplitude"
         self.min = scale.min
         self.max = scale.max
 
-    def apply_perturbation(self, vcg_ode_original):
-        scale = np.random.randint(self.min, self.max)
+    def sample_values(self, rng=np.random, size=None):
+        return (rng.randint(self.min, self.max, size=size),)
 
+    def apply_perturbation(self, vcg_ode_original, scale):
         vcg_ode = copy.deepcopy(vcg_ode_original)
 
         b_x = vcg_ode.b_x
@@ -295,15 +326,18 @@ class TWaveAmplitude(Perturbation):
 
 
 class STChange(Perturbation):
+    param_names = ("scale",)
+
     def __init__(self, scale):
         super().__init__()
         self.name = "ST Change"
         self.min = scale.min
         self.max = scale.max
 
-    def apply_perturbation(self, vcg_ode_original):
-        scale = np.random.randint(self.min, self.max)
+    def sample_values(self, rng=np.random, size=None):
+        return (rng.randint(self.min, self.max, size=size),)
 
+    def apply_perturbation(self, vcg_ode_original, scale):
         vcg_ode = copy.deepcopy(vcg_ode_original)
 
         b_x = vcg_ode.b_x
@@ -344,7 +378,7 @@ class InvertTWaves(Perturbation):
         self.name = "Invert T Waves"
         self.invert_prob = invert_prob
 
-    def apply_perturbation(self, vcg_ode_original):
+    def apply_perturbation(self, vcg_ode_original, *values):
         # vcg_ode = copy.deepcopy(vcg_ode_original)
         # # randomly select a value between min and max
         # if np.random.rand() < self.invert_prob:
@@ -372,16 +406,20 @@ class InvertTWaves(Perturbation):
 
 
 class STElevation(Perturbation):
+    param_names = ("percent_elevated",)
+
     def __init__(self, percent_elevated):
         self.name = "ST Elevation"
         self.min = percent_elevated.min
         self.max = percent_elevated.max
 
-    def apply_perturbation(self, vcg_ode_original):
+    def sample_values(self, rng=np.random, size=None):
+        # randomly select a value between min and max
+        return (rng.randint(self.min, self.max, size=size),)
+
+    def apply_perturbation(self, vcg_ode_original, percent_elevated):
         vcg_ode = copy.deepcopy(vcg_ode_original)
         return vcg_ode
-        # randomly select a value between min and max
-        percent_elevated = np.random.randint(self.min, self.max)
 
         th_x = vcg_ode.theta_x
         th_y = vcg_ode.theta_y
@@ -411,17 +449,21 @@ class STElevation(Perturbation):
 
 
 class STDepression(Perturbation):
+    param_names = ("percent_depressed",)
+
     def __init__(self, percent_depressed):
         super().__init__()
         self.name = "ST Depression"
         self.min = percent_depressed.min
         self.max = percent_depressed.max
 
-    def apply_perturbation(self, vcg_ode_original):
+    def sample_values(self, rng=np.random, size=None):
+        # randomly select a value between min and max
+        return (rng.randint(self.min, self.max, size=size),)
+
+    def apply_perturbation(self, vcg_ode_original, percent_depressed):
         vcg_ode = copy.deepcopy(vcg_ode_original)
         return vcg_ode
-        # randomly select a value between min and max
-        percent_depressed = np.random.randint(self.min, self.max)
 
         th_x = vcg_ode.theta_x
         th_y = vcg_ode.theta_y
@@ -451,26 +493,32 @@ class STDepression(Perturbation):
 
 
 class ModifyParameters(Perturbation):
+    param_names = ("scale", "noise_seed")
+
     def __init__(self, scale):
         super().__init__()
         self.name = "Modify Parameters"
         self.scale_min = scale.min
         self.scale_max = scale.max
 
-    def apply_perturbation(self, vcg_ode_original):
+    def sample_values(self, rng=np.random, size=None):
+        # the noise itself is too big to plan, so only its seed is drawn up front
+        return rng.uniform(self.scale_min, self.scale_max, size=size), rng.randint(2**31, size=size)
+
+    def apply_perturbation(self, vcg_ode_original, perturbation_scale, noise_seed):
         vcg_ode = copy.deepcopy(vcg_ode_original)
-        perturbation_scale = np.random.uniform(self.scale_min, self.scale_max)
+        noise = np.random.RandomState(int(noise_seed))
 
-        vcg_ode.alpha_x += np.random.normal(scale=perturbation_scale, size=vcg_ode.alpha_x.shape)
-        vcg_ode.alpha_y += np.random.normal(scale=perturbation_scale, size=vcg_ode.alpha_y.shape)
-        vcg_ode.alpha_z += np.random.normal(scale=perturbation_scale, size=vcg_ode.alpha_z.shape)
+        vcg_ode.alpha_x += noise.normal(scale=perturbation_scale, size=vcg_ode.alpha_x.shape)
+        vcg_ode.alpha_y += noise.normal(scale=perturbation_scale, size=vcg_ode.alpha_y.shape)
+        vcg_ode.alpha_z += noise.normal(scale=perturbation_scale, size=vcg_ode.alpha_z.shape)
 
-        vcg_ode.b_x += np.random.normal(scale=perturbation_scale, size=vcg_ode.b_x.shape)
-        vcg_ode.b_y += np.random.normal(scale=perturbation_scale, size=vcg_ode.b_y.shape)
-        vcg_ode.b_z += np.random.normal(scale=perturbation_scale, size=vcg_ode.b_z.shape)
+        vcg_ode.b_x += noise.normal(scale=perturbation_scale, size=vcg_ode.b_x.shape)
+        vcg_ode.b_y += noise.normal(scale=perturbation_scale, size=vcg_ode.b_y.shape)
+        vcg_ode.b_z += noise.normal(scale=perturbation_scale, size=vcg_ode.b_z.shape)
 
-        vcg_ode.theta_x += np.random.normal(scale=perturbation_scale, size=vcg_ode.theta_x.shape)
-        vcg_ode.theta_y += np.random.normal(scale=perturbation_scale, size=vcg_ode.theta_y.shape)
-        vcg_ode.theta_z += np.random.normal(scale=perturbation_scale, size=vcg_ode.theta_z.shape)
+        vcg_ode.theta_x += noise.normal(scale=perturbation_scale, size=vcg_ode.theta_x.shape)
+        vcg_ode.theta_y += noise.normal(scale=perturbation_scale, size=vcg_ode.theta_y.shape)
+        vcg_ode.theta_z += noise.normal(scale=perturbation_scale, size=vcg_ode.theta_z.shape)
 
         return vcg_ode
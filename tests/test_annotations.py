@@ -0,0 +1,137 @@
+import numpy as np
+import pytest
+
+from synth_ecg.utils.tools import (
+    Dower_lead_map,
+    Fiducial_map,
+    annotate_vcg_object,
+    convert_vcg_to_12lead,
+    fiducial_phases,
+    solve_vcg_object,
+)
+from synth_ecg.utils.vcg import VCG
+from synth_ecg.utils.vcg_perturbations import QTElongation, WideQRS
+
+FS = 500
+DURATION = 3
+FIDUCIALS = list(Fiducial_map)
+# the heart rate and QT elongation ranges in configs/generate_ecgs.yaml
+HEART_RATES = range(30, 201, 10)
+MS_FORWARD = range(50, 251, 25)
+
+
+def long_qt(hr, ms_forward):
+    perturbation = QTElongation.initialize(ms_forward={"min": 50, "max": 250})
+    return perturbation.apply_perturbation(VCG(hr), ms_forward)
+
+
+def default_vcg():
+    return VCG(60)
+
+
+def long_qt_vcg():
+    return long_qt(60, 100)
+
+
+def wide_qrs_vcg():
+    perturbation = WideQRS.initialize(percent_widened={"min": 100, "max": 1000}, scale={"min": 1, "max": 2})
+    return perturbation.apply_perturbation(VCG(60), 300, 1)
+
+
+def overlapping_t_vcg():
+    # a QT longer than the 400 ms beat
+    return long_qt(150, 250)
+
+
+VCGS = pytest.mark.parametrize(
+    "make_vcg",
+    [default_vcg, long_qt_vcg, wide_qrs_vcg, overlapping_t_vcg],
+    ids=lambda f: f.__name__,
+)
+
+
+def relative_to_p_on(phases):
+    # position within the cycle starting at P_on, in [0, 2pi)
+    return {name: np.remainder(phase - phases["P_on"], 2 * np.pi) for name, phase in phases.items()}
+
+
+def assert_ordered(phases):
+    u = relative_to_p_on(phases)
+
+    assert u["P_on"] < u["P_peak"] < u["P_off"] <= u["QRS_on"] < u["R_peak"] < u["QRS_off"]
+    # the T wave is either delimited within the beat or left out
+    if "T_off" in u:
+        assert u["QRS_off"] <= u["T_on"] < u["T_peak"] < u["T_off"]
+    else:
+        assert list(u) == FIDUCIALS[:6]
+
+
+@VCGS
+def test_fiducial_phases_are_ordered(make_vcg):
+    assert_ordered(fiducial_phases(make_vcg()))
+
+
+@pytest.mark.parametrize("hr", HEART_RATES)
+@pytest.mark.parametrize("ms_forward", MS_FORWARD)
+def test_fiducial_phases_are_ordered_with_long_qt(hr, ms_forward):
+    assert_ordered(fiducial_phases(long_qt(hr, ms_forward)))
+
+
+@pytest.mark.parametrize("hr", HEART_RATES)
+def test_t_wave_is_annotated_without_qt_elongation(hr):
+    assert list(fiducial_phases(VCG(hr))) == FIDUCIALS
+
+
+def test_t_wave_running_into_next_beat_is_left_out():
+    assert "T_off" in fiducial_phases(long_qt(150, 50))
+    assert "T_off" not in fiducial_phases(overlapping_t_vcg())
+
+
+def test_qt_elongation_delays_t_wave():
+    default = relative_to_p_on(fiducial_phases(default_vcg()))
+    elongated = relative_to_p_on(fiducial_phases(long_qt_vcg()))
+
+    assert elongated["T_peak"] > default["T_peak"]
+    assert elongated["T_off"] > default["T_off"]
+
+
+def test_wide_qrs_widens_qrs():
+    default = relative_to_p_on(fiducial_phases(default_vcg()))
+    wide = relative_to_p_on(fiducial_phases(wide_qrs_vcg()))
+
+    assert wide["QRS_off"] - wide["QRS_on"] > default["QRS_off"] - default["QRS_on"]
+
+
+@VCGS
+def test_annotations_follow_beat_order(make_vcg):
+    vcg_ode = make_vcg()
+    annotations = annotate_vcg_object(vcg_ode, fs=FS, duration=DURATION)
+
+    assert (np.diff(annotations[:, 1]) >= 0).all()
+    assert (annotations[:, 1] >= 0).all() and (annotations[:, 1] < DURATION * FS).all()
+    # after the first full beat starts, fiducials repeat in order
+    codes = list(annotations[:, 0])
+    start = codes.index(Fiducial_map["P_on"])
+    expected = [Fiducial_map[name] for name in fiducial_phases(vcg_ode)] * len(codes)
+    assert codes[start:] == expected[: len(codes) - start]
+
+
+@VCGS
+def test_r_peaks_land_on_lead_ii_maxima(make_vcg):
+    vcg_ode = make_vcg()
+    _, vcg = solve_vcg_object(vcg_ode, fs=FS, duration=DURATION)
+    lead_ii = convert_vcg_to_12lead(vcg)[:, Dower_lead_map["II"]]
+    annotations = annotate_vcg_object(vcg_ode, fs=FS, duration=DURATION)
+    r_peaks = annotations[annotations[:, 0] == Fiducial_map["R_peak"], 1]
+
+    # at least 60 bpm over 3 seconds
+    assert len(r_peaks) >= 2
+    half = int(0.02 * FS)
+    checked = 0
+    for r_peak in r_peaks:
+        if r_peak - half < 0 or r_peak + half >= len(lead_ii):
+            continue
+        window = lead_ii[r_peak - half : r_peak + half + 1]
+        assert abs(np.argmax(window) - half) <= 2
+        checked += 1
+    assert checked >= 1
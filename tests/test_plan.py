@@ -0,0 +1,119 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+from omegaconf import OmegaConf
+
+from synth_ecg.generator import ECGGenerator
+
+
+def make_generator(tmp_path, **overrides):
+    params = OmegaConf.create(
+        {
+            "n_jobs": 2,
+            "task_size": 2,
+            "max_in_flight": 2,
+            "memmap_output": False,
+            "annotate": False,
+            "compute_stats": False,
+            "output_dir": str(tmp_path),
+            "n_samples": 8,
+            "sample_params": {"leads": 12, "frequency": 50, "duration": 2, "save_duration": 1},
+            "generation_params": {"seed": 0, "heart_rate": {"min": 60, "max": 62, "step": 0.1}},
+        }
+    )
+    return ECGGenerator(OmegaConf.merge(params, overrides))
+
+
+def test_plan_is_reproducible(tmp_path):
+    generator = make_generator(tmp_path)
+    first = generator.plan_ecgs()
+    second = ECGGenerator.load_plan(generator.save_plan(generator.plan_ecgs()))
+
+    pd.testing.assert_frame_equal(first, second, check_names=False)
+
+
+def test_plan_tasks_cover_every_sample_once(tmp_path):
+    generator = make_generator(tmp_path, n_samples=50)
+    plan = generator.plan_ecgs()
+    tasks = list(generator._iter_plan_tasks(plan))
+
+    indices = np.concatenate([indices for _, _, indices, _ in tasks])
+    assert sorted(indices) == list(range(len(plan)))
+    # only two heart rates, so tasks share solves but stay within task_size
+    assert len(tasks) < len(plan)
+    for hr, _, indices, start_points in tasks:
+        assert len(indices) <= generator.task_size
+        assert (plan["hr"].to_numpy()[indices] == hr).all()
+        np.testing.assert_array_equal(plan["start_point"].to_numpy()[indices], start_points)
+
+
+@pytest.mark.parametrize("memmap_output", [False, True])
+def test_deduplicated_output_matches_per_sample_solves(tmp_path, memmap_output):
+    generator = make_generator(tmp_path, memmap_output=memmap_output)
+    plan = generator.plan_ecgs()
+    assert plan["hr"].nunique() < len(plan)
+
+    ecgs = generator.generate_ecgs(plan)
+    expected = np.stack(
+        [generator.crop_ecg(generator.solve_ecg(row.hr), row.start_point) for row in plan.itertuples()]
+    )
+
+    assert generator.n_generated == len(plan)
+    np.testing.assert_array_equal(np.asarray(ecgs), expected)
+
+
+class CountingExecutor(ThreadPoolExecutor):
+    # runs tasks in one thread and records the most futures pending at once
+    def __init__(self):
+        super().__init__(max_workers=1)
+        self.lock = threading.Lock()
+        self.n_submitted = 0
+        self.n_pending = 0
+        self.max_pending = 0
+
+    def _done(self, future):
+        with self.lock:
+            self.n_pending -= 1
+
+    def submit(self, fn, *args, **kwargs):
+        with self.lock:
+            self.n_submitted += 1
+            self.n_pending += 1
+            self.max_pending = max(self.max_pending, self.n_pending)
+        future = super().submit(fn, *args, **kwargs)
+        future.add_done_callback(self._done)
+        return future
+
+
+def test_in_flight_solves_stay_bounded(tmp_path):
+    generator = make_generator(tmp_path, n_samples=12, task_size=1, max_in_flight=3)
+    with CountingExecutor() as executor:
+        ecgs = generator.generate_ecgs(executor=executor)
+
+    assert generator.n_generated == len(ecgs) == 12
+    assert executor.n_submitted == 12
+    assert executor.max_pending <= generator.max_in_flight
+
+
+def test_memmapped_annotations_match_in_memory_ones(tmp_path):
+    in_memory = make_generator(tmp_path / "in_memory", annotate=True)
+    plan = in_memory.plan_ecgs()
+    in_memory.generate_ecgs(plan)
+
+    memmapped = make_generator(tmp_path / "memmapped", annotate=True, memmap_output=True)
+    memmapped.generate_ecgs(plan)
+    fp = memmapped.save_annotations(memmapped.annotations)
+
+    assert not os.path.exists(f"{fp}.part")
+    annotations = np.load(fp)
+    # memmapped rows are grouped by record in completion order, so compare them sorted
+    assert len(annotations) == len(in_memory.annotations) > 0
+
+    def by_row(rows):
+        return rows[np.lexsort(rows.T[::-1])]
+
+    np.testing.assert_array_equal(by_row(annotations), by_row(in_memory.annotations))
@@ -0,0 +1,95 @@
+import asyncio
+import json
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+from omegaconf import OmegaConf
+
+from synth_ecg import server as server_module
+from synth_ecg.server import ECGServer, request_ecgs
+
+QT_TARGET = "synth_ecg.utils.vcg_perturbations.QTElongation.initialize"
+
+
+def make_params():
+    return OmegaConf.create(
+        {
+            "n_jobs": 2,
+            "sample_params": {"leads": 12, "frequency": 50, "duration": 2, "save_duration": 1},
+            "generation_params": {"heart_rate": {"min": 60, "max": 90, "step": 0.1}},
+        }
+    )
+
+
+def fetch(socket_path, request):
+    return asyncio.run(request_ecgs(socket_path=socket_path, **request))
+
+
+def serve_requests(tmp_path, requests, **server_kwargs):
+    # pool workers are forked with the server's sockets open, so a client in this process would
+    # never see its connection close. clients run in spawned processes instead
+    async def run():
+        server = ECGServer(make_params(), **server_kwargs)
+        socket_path = str(tmp_path / "ecgs.sock")
+        await server.start()
+        unix_server = await asyncio.start_unix_server(server.handle_client, path=socket_path)
+        try:
+            loop = asyncio.get_running_loop()
+            with ProcessPoolExecutor(len(requests), mp_context=get_context("spawn")) as clients:
+                return await asyncio.gather(
+                    *(loop.run_in_executor(clients, fetch, socket_path, request) for request in requests),
+                    return_exceptions=True,
+                )
+        finally:
+            unix_server.close()
+            await server.stop()
+
+    return asyncio.run(run())
+
+
+def test_seeded_requests_dont_depend_on_coalescing(tmp_path):
+    request = {"count": 6, "seed": 0}
+    (alone,) = serve_requests(tmp_path, [request], max_wait_ms=0, chunk_size=1)
+    together = serve_requests(
+        tmp_path, [request, {"count": 5, "seed": 1}, request], max_wait_ms=200, chunk_size=16
+    )
+
+    assert alone.shape == (6, 50, 12)
+    np.testing.assert_array_equal(together[0], alone)
+    np.testing.assert_array_equal(together[2], alone)
+    assert not np.array_equal(together[1], alone[:5])
+
+
+def test_rejects_non_perturbation_targets(tmp_path):
+    bad_target = {"count": 1, "perturbations": [{"_target_": "os.system", "command": "true"}]}
+    hidden_target = {"_target_": QT_TARGET, "ms_forward": {"_target_": "os.getcwd"}}
+    bad_param = {"count": 1, "perturbations": [hidden_target]}
+    rejected = serve_requests(tmp_path, [bad_target, bad_param, {"count": 1, "seed": 0}])
+
+    assert isinstance(rejected[0], ValueError) and "Perturbation target" in str(rejected[0])
+    assert isinstance(rejected[1], ValueError) and "Invalid perturbation parameter" in str(rejected[1])
+    # the connection is still served after a rejected request
+    assert rejected[2].shape == (1, 50, 12)
+
+
+def test_failing_spec_returns_nan_records(tmp_path):
+    # a known target, but ms_forward needs min and max
+    broken = {"count": 3, "seed": 0, "perturbations": [{"_target_": QT_TARGET, "ms_forward": 100}]}
+    ecgs, healthy = serve_requests(tmp_path, [broken, {"count": 2, "seed": 0}])
+
+    assert ecgs.shape == (3, 50, 12)
+    assert np.isnan(ecgs).all()
+    assert np.isfinite(healthy).all()
+
+
+def test_worker_generator_cache_is_bounded(monkeypatch):
+    params = OmegaConf.to_container(OmegaConf.merge(make_params(), {"n_jobs": 1}))
+    monkeypatch.setattr(server_module, "_WORKER_PARAMS", params)
+    server_module._get_worker_generator.cache_clear()
+    for ms_forward in range(server_module._MAX_WORKER_GENERATORS + 4):
+        perturbations = [{"_target_": QT_TARGET, "ms_forward": {"min": ms_forward, "max": ms_forward + 1}}]
+        server_module._get_worker_generator(json.dumps(perturbations, sort_keys=True))
+
+    assert server_module._get_worker_generator.cache_info().currsize == server_module._MAX_WORKER_GENERATORS
+    server_module._get_worker_generator.cache_clear()
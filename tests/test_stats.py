@@ -0,0 +1,69 @@
+import numpy as np
+
+from synth_ecg.utils.stats import ECGStats
+
+
+def make_records():
+    rng = np.random.default_rng(0)
+    records = 2 * rng.normal(size=(10, 50, 3))
+    records[3, 5, 1] = np.nan
+    records[4, 7, 0] = 12.0
+    records[7, :, 2] = 0.5
+    return records
+
+
+def test_merge_matches_single_pass():
+    records = make_records()
+    single = ECGStats(3)
+    for i, record in enumerate(records):
+        single.update(i, record)
+
+    first, second = ECGStats(3), ECGStats(3)
+    for i in range(4):
+        first.update(i, records[i])
+    for i in range(4, len(records)):
+        second.update(i, records[i])
+    merged = ECGStats(3).merge(second).merge(first)
+
+    assert merged.n_records == single.n_records == len(records)
+    np.testing.assert_array_equal(merged.count, single.count)
+    np.testing.assert_allclose(merged.mean, single.mean)
+    np.testing.assert_allclose(merged.std, single.std)
+    np.testing.assert_array_equal(merged.min, single.min)
+    np.testing.assert_array_equal(merged.max, single.max)
+    np.testing.assert_array_equal(merged.hist, single.hist)
+    assert merged.to_dict()["flagged"] == single.to_dict()["flagged"]
+
+
+def test_single_pass_matches_numpy():
+    records = make_records()
+    stats = ECGStats(3)
+    for i, record in enumerate(records):
+        stats.update(i, record)
+
+    for lead in range(3):
+        values = records[:, :, lead]
+        values = values[np.isfinite(values)]
+        assert stats.count[lead] == len(values)
+        np.testing.assert_allclose(stats.mean[lead], values.mean())
+        np.testing.assert_allclose(stats.std[lead], values.std())
+        assert stats.min[lead] == values.min() and stats.max[lead] == values.max()
+        # out of range values land in the end bins
+        expected = np.histogram(np.clip(values, stats.bins[0], stats.bins[-1]), bins=stats.bins)[0]
+        np.testing.assert_array_equal(stats.hist[lead], expected)
+
+    assert stats.flagged == {"non_finite": [3], "flat_line": [7], "t_wave_overlap": []}
+
+
+def test_reindex_renumbers_flagged_records():
+    stats = ECGStats(3)
+    records = make_records()
+    for i, record in enumerate(records):
+        stats.update(i, record)
+
+    # records 0 and 5 failed and were dropped from the output
+    generated = np.ones(len(records), dtype=bool)
+    generated[[0, 5]] = False
+    stats.reindex(np.cumsum(generated) - 1)
+
+    assert stats.flagged == {"non_finite": [2], "flat_line": [5], "t_wave_overlap": []}
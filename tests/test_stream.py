@@ -0,0 +1,62 @@
+import numpy as np
+from omegaconf import OmegaConf
+from scipy.integrate import solve_ivp
+
+from synth_ecg.generator import ECGGenerator
+from synth_ecg.utils.tools import stream_vcg_object
+from synth_ecg.utils.vcg import VCG
+
+FS = 100
+DURATION = 3
+# doesn't divide DURATION, so the last chunk is short
+CHUNK_DURATION = 0.7
+V0 = np.array([0, 0.3, 0.3, 0.3])
+
+
+def solve_at_once(vcg_ode):
+    # one solve over the same grid stream_vcg_object uses, dropping the first 10 seconds
+    n_settle = 10 * FS
+    t_eval = np.arange(n_settle + DURATION * FS) / FS
+    sol = solve_ivp(vcg_ode.call, [t_eval[0], t_eval[-1]], V0, t_eval=t_eval)
+    return sol.t[n_settle:], sol.y[1:, n_settle:].T
+
+
+def make_generator(tmp_path):
+    params = OmegaConf.create(
+        {
+            "n_jobs": 1,
+            "output_dir": str(tmp_path),
+            "n_samples": 1,
+            "sample_params": {"leads": 12, "frequency": FS, "duration": DURATION, "save_duration": DURATION},
+            "generation_params": {"heart_rate": {"min": 60, "max": 62, "step": 0.1}},
+        }
+    )
+    return ECGGenerator(params)
+
+
+def test_streamed_chunks_match_one_solve():
+    vcg_ode = VCG(70)
+    chunks = list(stream_vcg_object(vcg_ode, fs=FS, duration=DURATION, chunk_duration=CHUNK_DURATION, v0=V0))
+    t = np.concatenate([chunk_t for chunk_t, _ in chunks])
+    vcg = np.concatenate([chunk_vcg for _, chunk_vcg in chunks])
+    expected_t, expected_vcg = solve_at_once(vcg_ode)
+
+    assert [len(chunk_t) for chunk_t, _ in chunks] == [70, 70, 70, 70, 20]
+    # no sample dropped or repeated at the chunk boundaries
+    np.testing.assert_array_equal(t, expected_t)
+    # the state is carried across boundaries, so only the solver's step choices differ (a sample
+    # off would be out by ~1 mV around the QRS)
+    np.testing.assert_allclose(vcg, expected_vcg, atol=0.1)
+
+
+def test_save_long_ecg_writes_every_sample(tmp_path):
+    generator = make_generator(tmp_path)
+    fp = generator.save_long_ecg(70, DURATION, str(tmp_path / "holter.npy"), chunk_duration=CHUNK_DURATION)
+    ecg = np.load(fp)
+
+    assert ecg.shape == (DURATION * FS, 12)
+    np.testing.assert_array_equal(
+        ecg, np.concatenate(list(generator.stream_ecg(70, DURATION, chunk_duration=CHUNK_DURATION)))
+    )
+    _, expected_vcg = solve_at_once(VCG(70))
+    np.testing.assert_allclose(ecg, generator.vcg_to_leads(expected_vcg), atol=0.2)
@@ -0,0 +1,55 @@
+import os
+
+import numpy as np
+from hydra import compose, initialize_config_module
+from omegaconf import OmegaConf
+
+from synth_ecg.generator import ECGGenerator
+from synth_ecg.sweep import make_generators, run_sweep
+
+
+def make_generator(output_dir, hr_min, hr_max, n_samples):
+    params = OmegaConf.create(
+        {
+            "n_jobs": 2,
+            "output_dir": str(output_dir),
+            "n_samples": n_samples,
+            "sample_params": {"leads": 12, "frequency": 50, "duration": 2, "save_duration": 1},
+            "generation_params": {"seed": 0, "heart_rate": {"min": hr_min, "max": hr_max, "step": 0.1}},
+        }
+    )
+    return ECGGenerator(params)
+
+
+def test_run_sweep_writes_each_variant_to_its_own_dir(tmp_path):
+    generators = [
+        make_generator(tmp_path / "low_hr", 40, 60, n_samples=4),
+        make_generator(tmp_path / "high_hr", 100, 120, n_samples=6),
+    ]
+    summary = run_sweep(generators, n_jobs=2)
+
+    assert list(summary["output_dir"]) == [str(tmp_path / "low_hr"), str(tmp_path / "high_hr")]
+    assert list(summary["n_generated"]) == list(summary["n_samples"]) == [4, 6]
+    assert (summary["ecgs_per_second"] > 0).all()
+    for generator in generators:
+        assert np.load(generator.save_fp).shape == (generator.cfg.n_samples, 50, 12)
+        assert os.path.exists(f"{generator.cfg.output_dir}/plan.csv")
+
+
+def test_sweep_entries_override_the_base_generator(tmp_path):
+    with initialize_config_module(config_module="synth_ecg.configs", version_base=None):
+        cfg = compose("sweep_ecgs", overrides=[f"output_dir={tmp_path}", "n_jobs=1"])
+    base = cfg.generator.params
+    low_hr, long_qt = make_generators(cfg)
+
+    assert low_hr.cfg.output_dir == f"{tmp_path}/low_hr"
+    assert long_qt.cfg.output_dir == f"{tmp_path}/long_qt"
+    assert low_hr.cfg.generation_params.heart_rate.min == 30
+    assert long_qt.cfg.generation_params.heart_rate.max == 100
+    assert len(low_hr.perturbations) == 0
+    assert [type(perturbation).__name__ for perturbation in long_qt.perturbations] == ["QTElongation"]
+    # everything else comes from the base generator
+    for generator in (low_hr, long_qt):
+        assert generator.cfg.n_jobs == 1
+        assert generator.cfg.generation_params.heart_rate.step == base.generation_params.heart_rate.step
+        assert generator.cfg.sample_params == base.sample_params